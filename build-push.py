@@ -1,22 +1,42 @@
 import argparse
 import chevron
+import concurrent.futures
 import copy
+import hashlib
+import heapq
+import json
 import logging
+import os
 import pathlib
 import shutil
 import subprocess
 import sys
 import requests
-import re
+import requests.adapters
 
 
 THIS_DIR = pathlib.Path(__file__).parent
 BUILD_DIR = THIS_DIR / 'build'
+# Where we remember what we built last time so we can skip rebuilding images that haven't changed. See build_one.
+STATE_DIR = BUILD_DIR / '.state'
+# Where we remember the Dockerhub tag data from previous runs. See get_max_version.
+HUB_CACHE_FILE = pathlib.Path.home() / '.cache' / 'mvpstudio-build-push.json'
 
 
 logging.basicConfig(level=logging.INFO, stream=sys.stderr)
 log = logging.getLogger(__name__)
 
+# The maximum number of Dockerhub requests we'll have in flight at once.
+HUB_CONCURRENCY = 16
+# How long to wait, in seconds, for Dockerhub to respond before giving up on (and maybe retrying) a request.
+HUB_TIMEOUT = 10
+# The maximum number of images we'll push at once.
+PUSH_CONCURRENCY = 4
+# How much of the end of the docker output to show when a build or push fails. See run_logged.
+LOG_TAIL_LINES = 50
+# How much of a context file to read at once when hashing it. See content_hash.
+HASH_CHUNK_SIZE = 1024 * 1024
+
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -29,11 +49,62 @@ def parse_args():
                         '--no_depends is given). The values passed should be repo names omitting the mvpstudio/ prefix '
                         '(e.g. like "base" to indicate mvpstudio/base). Can pass this argument more than once to build '
                         'more than one container.')
+    parser.add_argument('-n', '--no_depends', action='store_true', default=False,
+                        help='If given along with --only, build only the containers passed to --only. Anything they '
+                        'depend on is not rebuilt; the latest version of it on Dockerhub is used instead.')
+    parser.add_argument('-c', '--no_cache', action='store_true', default=False,
+                        help='If given, do not reuse any images or layers from earlier builds; rebuild everything from '
+                        'scratch. Use this to make sure the images pick up the latest versions of the packages they '
+                        'install.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='The number of images to build concurrently. Only images whose dependencies have all been '
+                        'built are run at the same time so this is safe to use with any value of 1 or more.')
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.no_depends and args.only is None:
+        parser.error('--no_depends can only be used along with --only')
     return args
 
 
-def get_max_version(repo):
+def make_hub_session():
+    """Returns a requests.Session for talking to Dockerhub. The session is safe to share between the threads running
+    get_max_version and keeps enough connections open that none of them have to wait for a new TCP/TLS handshake.
+    Dockerhub rate limits and has the occasional hiccup so requests that get a 429 or 5xx are retried with exponential
+    backoff (honoring any Retry-After header)."""
+    session = requests.Session()
+    retry = requests.adapters.Retry(
+        total=8, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], respect_retry_after_header=True)
+    adapter = requests.adapters.HTTPAdapter(
+        max_retries=retry, pool_connections=HUB_CONCURRENCY, pool_maxsize=HUB_CONCURRENCY)
+    session.mount('https://', adapter)
+    return session
+
+
+def load_hub_cache():
+    """Returns the cache of Dockerhub tag data written by save_hub_cache on a previous run, or an empty cache if there
+    isn't one."""
+    try:
+        with open(HUB_CACHE_FILE, 'r') as inf:
+            return json.load(inf)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        log.warning('Ignoring corrupt Dockerhub tag cache %s', HUB_CACHE_FILE)
+        return {}
+
+
+def save_hub_cache(cache):
+    """Writes the cache of Dockerhub tag data so the next run can use it."""
+    HUB_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file and then move it into place so an interrupted run can't leave a half-written cache.
+    tmp_file = HUB_CACHE_FILE.with_name(HUB_CACHE_FILE.name + '.tmp')
+    with open(tmp_file, 'w') as outf:
+        json.dump(cache, outf, indent=2, sort_keys=True)
+    os.replace(str(tmp_file), str(HUB_CACHE_FILE))
+
+
+def get_max_version(repo, session, cache):
     """Returns a list of the largest integer extracted from a tag in the format vX. Tags that don't match vX where X is
     an integer are ignored. If no matching tags are found a 0 is returned.
 
@@ -41,6 +112,14 @@ def get_max_version(repo):
     ----------
     repo : str
         The short repo name; that is, the name omitting the `mvpstudio/` prefix.
+
+    session : requests.Session
+        The session to use for the HTTP requests, as returned by make_hub_session.
+
+    cache : dict
+        The cache returned by load_hub_cache. If we have an entry for this repo we send a conditional request and, if
+        Dockerhub says nothing has changed, return the cached value without fetching any of the tag data. The entry for
+        this repo is updated with the result of this call.
     """
     # Note that the following is an undocumented dockerhub API. It appears to be the standard v2 API
     # (https://docs.docker.com/registry/spec/api/#listing-image-tags) given the `v2/` part of the URL but it isn't.
@@ -50,33 +129,55 @@ def get_max_version(repo):
     #
     # Note the missing `repositories/` and the additonal `list` in the URL. We don't use the V2 API however since that
     # requires authentication and all we need is the public tag data.
-    tag_re = re.compile('^v(\d+)$')
     max_tag = 0
     page_size = 100
-    next = 'https://registry.hub.docker.com/v2/repositories/mvpstudio/%s/tags?page_size=%s' % (repo, page_size)
+    # Ask for the most recently updated tags first so pushing a new tag always changes the first page. Thus if the
+    # first page hasn't changed since we cached it, the maximum version hasn't changed either.
+    next = 'https://registry.hub.docker.com/v2/repositories/mvpstudio/%s/tags?page_size=%s&ordering=last_updated' % (
+        repo, page_size)
+
+    cached = cache.get(repo)
+    headers = {}
+    if cached is not None:
+        if cached.get('etag') is not None:
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified') is not None:
+            headers['If-Modified-Since'] = cached['last_modified']
+
     log.info('Fetching tag information for %s', repo)
+    result = session.get(next, headers=headers, timeout=HUB_TIMEOUT)
+    if result.status_code == 304:
+        log.info('Tag information for %s has not changed since the last run', repo)
+        return cached['max_tag']
+    etag = result.headers.get('ETag')
+    last_modified = result.headers.get('Last-Modified')
     while True:
-        result = requests.get(next)
         result.raise_for_status()
         result_json = result.json()
         for tag_data in result_json['results']:
-            log.debug('Found tag: %s', tag_data['name'])
-            m = tag_re.fullmatch(tag_data['name'])
-            if m is not None:
-                tag_version = int(m.group(1))
-                max_tag = max(max_tag, tag_version)
+            name = tag_data['name']
+            log.debug('Found tag: %s', name)
+            # Every tag on every page goes through here so use plain string methods rather than a regex.
+            if name.startswith('v') and name[1:].isdecimal():
+                max_tag = max(max_tag, int(name[1:]))
             else:
-                log.debug('Ignoring tag %s as it is not in vX format with X being an integer.', tag_data['name'])
+                log.debug('Ignoring tag %s as it is not in vX format with X being an integer.', name)
         if result_json['next'] is None:
             break
         else:
             next = result_json['next']
+            result = session.get(next, timeout=HUB_TIMEOUT)
+
+    if etag is not None or last_modified is not None:
+        cache[repo] = {'etag': etag, 'last_modified': last_modified, 'max_tag': max_tag}
+    else:
+        cache.pop(repo, None)
     return max_tag
 
 
 class ImageToBuild:
     """An image to be built."""
-    def __init__(self, directory, version, deps):
+    def __init__(self, directory, version, tokens):
         """Constructor.
 
         Parameters
@@ -85,16 +186,23 @@ class ImageToBuild:
             Path to the directory holding the container.yml and Dockerfile.template files.
 
         version : int
-            The version of the container to build and push.
+            The version of the container to build and push. May be None if we haven't yet asked Dockerhub what the
+            latest version is; it must be set before the image is built.
 
-        deps : list of str
-            A list of other containers upon which this one depends. Should be just a short repo name (e.g.
-            "base"). We'll figure out the version that corresponds to by pulling the repo data for the dependency from
-            Dockerhub.
+        tokens : list of tuple
+            The Dockerfile.template as tokenized by chevron.tokenizer.tokenize. We keep these around so we only have to
+            parse the template once no matter how many times it gets rendered, and we find the dependencies from them
+            too.
         """
         self.directory = directory
         self.version = version
-        self.deps = deps
+        self.tokens = tokens
+        # The other containers upon which this one depends: every repo whose version the template refers to, each
+        # listed once. These are just short repo names (e.g. "base").
+        self.deps = []
+        for tag_type, key in tokens:
+            if tag_type in ('variable', 'no escape') and key not in self.deps:
+                self.deps.append(key)
 
     @property
     def repo(self):
@@ -111,47 +219,299 @@ class ImageToBuild:
         """The stringified version, with leading `v` and left-padded 0's."""
         return 'v%03d' % self.version
 
+    @property
+    def previous_string_version(self):
+        """Like string_version but for the version before this one; that is, the latest version on Dockerhub."""
+        return 'v%03d' % (self.version - 1)
+
+    @property
+    def tag(self):
+        """The full repo and version; that is, the tag that we build."""
+        return '%s:%s' % (self.full_repo, self.string_version)
+
+
+def link_or_copy(src, dst):
+    """A copy_function for shutil.copytree that hard links dst to src, falling back to copying the file if it can't
+    (e.g. because the build directory is on a different filesystem)."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def content_hash(to_build, rendered, dep_versions):
+    """Returns a hash of everything that goes into building an image: the files in its context, its rendered
+    Dockerfile, and the versions of the images it depends on.
+
+    Parameters
+    ----------
+    to_build : ImageToBuild
+        The image whose inputs we should hash.
+
+    rendered : str
+        The rendered Dockerfile.
+
+    dep_versions : dict from str to str
+        As passed to build_one. Only the entries for the images to_build depends on are hashed.
+    """
+    h = hashlib.blake2b()
+
+    def add(data):
+        # Prefix everything with its length so different inputs can't run together into the same bytes.
+        h.update(b'%d:' % len(data))
+        h.update(data)
 
-def build_one(to_build, built, push):
+    add(rendered.encode('utf-8'))
+    # Only this image's own dependencies; the rest of dep_versions depends on what else happened to be built first.
+    own_deps = {d: dep_versions[d] for d in to_build.deps if d in dep_versions}
+    add(json.dumps(own_deps, sort_keys=True).encode('utf-8'))
+    context_dir = to_build.directory / 'context'
+    if context_dir.exists():
+        for path in sorted(p for p in context_dir.rglob('*') if p.is_file()):
+            add(path.relative_to(context_dir).as_posix().encode('utf-8'))
+            stat = path.stat()
+            # COPY keeps file permissions so they're as much a part of the image as the contents.
+            add(b'%o' % stat.st_mode)
+            # Read the file in chunks so a big context doesn't have to fit in memory.
+            h.update(b'%d:' % stat.st_size)
+            with open(path, 'rb') as inf:
+                for chunk in iter(lambda: inf.read(HASH_CHUNK_SIZE), b''):
+                    h.update(chunk)
+    return h.hexdigest()
+
+
+def state_file(to_build):
+    """Returns the path of the file recording the content_hash and tag of the last build of the given ImageToBuild."""
+    return STATE_DIR / ('%s.json' % to_build.repo)
+
+
+def save_state(to_build, h):
+    """Records that to_build.tag, which is now on Dockerhub, was built from the inputs with the given content_hash."""
+    STATE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(state_file(to_build), 'w') as outf:
+        json.dump({'hash': h, 'tag': to_build.tag}, outf)
+
+
+def can_reuse_previous(to_build, h):
+    """Returns True if the latest version of the image on Dockerhub is one we built from exactly the same inputs (as
+    given by content_hash) and we still have it locally, in which case there's no need to build it again."""
+    try:
+        with open(state_file(to_build), 'r') as inf:
+            state = json.load(inf)
+    except (FileNotFoundError, ValueError):
+        return False
+    previous_tag = '%s:%s' % (to_build.full_repo, to_build.previous_string_version)
+    if state.get('hash') != h or state.get('tag') != previous_tag:
+        return False
+    inspect = subprocess.run(['docker', 'image', 'inspect', previous_tag],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return inspect.returncode == 0
+
+
+def build_one(to_build, dep_versions, use_cache, echo):
     """Sets up the context, filling in the template information from Dockerfile.template, and runs docker build.
 
+    If use_cache is true and nothing that goes into the image has changed since we built the latest version on
+    Dockerhub, no new image is built and that version is used instead.
+
     Parameters
     ----------
     to_build : ImageToBuild
         The image we should build.
 
-    built : dict from str to ImageToBuild
-        A dict mapping the repo name of an image to the ImageToBuild for that image. This dict contains only
-        images that were already built.
+    dep_versions : dict from str to str
+        A dict mapping the repo name of an image that's available to build on to its string_version. This contains
+        only images that were already built or already on Dockerhub.
 
-    push : bool
-        If true push the image after building it. If false, don't.
+    use_cache : bool
+        If true let docker reuse layers, or the whole image, from earlier builds of this image. If false, build every
+        layer from scratch.
+
+    echo : bool
+        If true show the docker output on the terminal as well as in the log. See run_logged.
+
+    Returns
+    -------
+    str
+        The version of the image that should be used by the images that depend on this one. If it is
+        to_build.string_version a new image was built and should be pushed.
+
+    str
+        The content_hash of the image. Pass it to push_one so a later run can tell whether the pushed image is still
+        up to date.
     """
+    rendered = chevron.render(to_build.tokens, dep_versions)
+    h = content_hash(to_build, rendered, dep_versions)
+    if use_cache and can_reuse_previous(to_build, h):
+        log.info('Nothing has changed since %s:%s was built; using it rather than building %s',
+                 to_build.repo, to_build.previous_string_version, to_build.string_version)
+        return to_build.previous_string_version, h
+
     log.info('Building %s:%s', to_build.repo, to_build.string_version)
-    build_dir = BUILD_DIR / to_build.directory
+    build_dir = BUILD_DIR / to_build.repo
     if build_dir.exists():
         # Remove the build directory if it exists so we don't accidentally have some stale data in the docker context
         # from a previous build.
         shutil.rmtree(build_dir)
-    build_dir.mkdir(parents=True)
     context_dir = to_build.directory / 'context'
     if context_dir.exists():
-        shutil.copytree(context_dir, build_dir)
-
-    with open(to_build.directory / 'Dockerfile.template', 'r') as docker_template:
-        template_data = {repo: img.string_version for repo, img in built.items()}
-        rendered = chevron.render(docker_template, template_data)
-    with open(build_dir / 'Dockerfile', 'w') as outf:
+        build_dir.parent.mkdir(parents=True, exist_ok=True)
+        # docker build only reads the context so hard links are just as good as copies and far cheaper for big files.
+        shutil.copytree(context_dir, build_dir, copy_function=link_or_copy)
+    else:
+        build_dir.mkdir(parents=True)
+
+    dockerfile = build_dir / 'Dockerfile'
+    if dockerfile.exists():
+        # The context shouldn't have a Dockerfile but if it does it's a hard link and writing to it would overwrite
+        # the file in context/ too.
+        dockerfile.unlink()
+    with open(dockerfile, 'w') as outf:
         outf.write(rendered)
 
-    tag = '%s:%s' % (to_build.full_repo, to_build.string_version)
-    subprocess.check_call(['docker', 'build', '-t', tag, str(build_dir)])
+    # Build with BuildKit and embed the layer cache metadata in the image we push. That way the next build of this
+    # repo can reuse any unchanged layers from this one via --cache-from, even on a machine (like CI) that has never
+    # built it before.
+    build_cmd = ['docker', 'build', '--build-arg', 'BUILDKIT_INLINE_CACHE=1']
+    if not use_cache:
+        build_cmd += ['--no-cache']
+    elif to_build.version > 1:
+        build_cmd += ['--cache-from', '%s:%s' % (to_build.full_repo, to_build.previous_string_version)]
+    build_cmd += ['-t', to_build.tag, str(build_dir)]
+    # Start a fresh log; push_one appends to it.
+    log_path = log_file(to_build)
+    if log_path.exists():
+        log_path.unlink()
+    run_logged(build_cmd, log_path, echo, env=dict(os.environ, DOCKER_BUILDKIT='1'))
+    return to_build.string_version, h
+
+
+def push_one(to_build, h, echo):
+    """Pushes the image built by build_one for the given ImageToBuild to Dockerhub. If echo is true the docker output is
+    shown on the terminal as well as in the log.
+
+    h is the content_hash build_one returned. It's only recorded once the push has succeeded: an image that was never
+    pushed (because of --no_push or a failed push) isn't the latest version on Dockerhub so it mustn't be reused.
+    """
+    log.info('Pushing %s', to_build.tag)
+    run_logged(['docker', 'push', to_build.tag], log_file(to_build), echo)
+    save_state(to_build, h)
+
+
+def log_file(to_build):
+    """Returns the path of the file holding the docker output for the given ImageToBuild."""
+    return BUILD_DIR / ('%s.log' % to_build.repo)
 
-    if push:
-        subprocess.check_call(['docker', 'push', tag])
 
+def run_logged(cmd, log_path, echo, env=None):
+    """Runs a command, appending its stdout and stderr to log_path. With several builds running at once their output
+    would be an unreadable mess on the terminal; instead each gets its own log and we only show the end of it if the
+    command fails. When we're building one image at a time (as in CI, which also kills a step that's quiet for too long)
+    the output is shown on the terminal as it arrives too, each line prefixed with the log's name.
+
+    Parameters
+    ----------
+    cmd : list of str
+        The command to run.
+
+    log_path : pathlib.Path
+        The file to which the output should be appended.
 
-def do_builds(to_build, push):
+    echo : bool
+        If true also copy the output to our stdout as it arrives.
+
+    env : dict from str to str
+        The environment for the command. If None the command inherits ours.
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        If the command exits with a non-zero status.
+    """
+    log.info('Running %s; output is in %s', ' '.join(cmd), log_path)
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(log_path, 'ab') as outf:
+        if echo:
+            prefix = ('[%s] ' % log_path.stem).encode('utf-8')
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+            for line in proc.stdout:
+                outf.write(line)
+                # A single write per line so lines from a concurrent push don't get mixed up with ours.
+                sys.stdout.buffer.write(prefix + line)
+                sys.stdout.buffer.flush()
+            proc.stdout.close()
+        else:
+            proc = subprocess.Popen(cmd, stdout=outf, stderr=subprocess.STDOUT, env=env)
+        returncode = proc.wait()
+    if returncode != 0 and echo:
+        log.error('%s failed; see the output above or in %s', ' '.join(cmd), log_path)
+        raise subprocess.CalledProcessError(returncode, cmd)
+    elif returncode != 0:
+        with open(log_path, 'r', errors='replace') as inf:
+            tail = inf.readlines()[-LOG_TAIL_LINES:]
+        log.error('%s failed. The last %s lines of %s are:\n%s', ' '.join(cmd), len(tail), log_path, ''.join(tail))
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def find_cycles(graph):
+    """Returns the dependency cycles in a graph. This is Tarjan's strongly connected components algorithm, written
+    iteratively so a deep graph can't hit the recursion limit.
+
+    Parameters
+    ----------
+    graph : dict from str to list of str
+        Map from each repo to the repos on which it depends. Every dependency must also be a key in the dict.
+
+    Returns
+    -------
+    list of list of str
+        The repos in each cycle, sorted. An image that depends on itself is a cycle of one.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    cycles = []
+
+    def visit(repo):
+        index[repo] = lowlink[repo] = len(index)
+        stack.append(repo)
+        on_stack.add(repo)
+        # The repo and an iterator over the dependencies of it we have yet to look at.
+        return (repo, iter(graph[repo]))
+
+    for root in graph.keys():
+        if root in index:
+            continue
+        work = [visit(root)]
+        while len(work) > 0:
+            repo, deps = work[-1]
+            for dep in deps:
+                if dep not in index:
+                    work.append(visit(dep))
+                    break
+                elif dep in on_stack:
+                    lowlink[repo] = min(lowlink[repo], index[dep])
+            else:
+                # We've seen all of repo's dependencies.
+                work.pop()
+                if len(work) > 0:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[repo])
+                if lowlink[repo] == index[repo]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        component.append(member)
+                        if member == repo:
+                            break
+                    if len(component) > 1 or repo in graph[repo]:
+                        cycles.append(sorted(component))
+    return cycles
+
+
+def do_builds(to_build, prebuilt, push, jobs, use_cache):
     """Build everything in topological order.
 
     Parameters
@@ -159,44 +519,139 @@ def do_builds(to_build, push):
     to_build : dict from str to ImageToBuild
         Map from repo name to the ImageToBuild for everything that is to be built.
 
+    prebuilt : dict from str to str
+        Map from repo name to string version for images that images in to_build depend on but that we aren't
+        building; the existing image on Dockerhub will be used instead.
+
     push : bool
         Indicates if we should push the images after building them or not.
+
+    jobs : int
+        The maximum number of images to build at the same time. If this is 1 the docker output is also shown on the
+        terminal.
+
+    use_cache : bool
+        Indicates if docker may reuse layers from earlier builds or not.
     """
-    # build up a map from repo name to the ImageToBuild for images that we're ready to build (all their dependencies
-    # have been built).
-    ready = {}
+    # Nothing in a cycle can ever be built so say exactly what the problem is before we waste time building anything.
+    cycles = find_cycles({r: [d for d in c.deps if d in to_build] for r, c in to_build.items()})
+    if len(cycles) > 0:
+        for cycle in cycles:
+            log.error('These containers depend on each other so none of them can be built: %s', ', '.join(cycle))
+        sys.exit(2)
+
+    # Map from repo name to the repos in to_build that depend on it.
+    rdeps = {r: [] for r in to_build.keys()}
+    # Map from repo name to the number of its dependencies that haven't been built yet. Once this hits 0 the image is
+    # ready to be built. Dependencies that aren't in to_build or prebuilt never get built so they never count down.
+    remaining_deps = {}
     for candidate in to_build.values():
-        if len(candidate.deps) == 0:
-            log.info('%s has no dependencies and can be built immediately', candidate.repo)
-            ready[candidate.repo] = candidate
-    for r in ready.keys():
-        del to_build[r]
-
+        remaining_deps[candidate.repo] = len([d for d in candidate.deps if d not in prebuilt])
+        for dep in candidate.deps:
+            if dep in rdeps:
+                rdeps[dep].append(candidate.repo)
+
+    chain_depths = {}
+
+    def chain_depth(repo):
+        """The number of images in the longest chain of builds that starts with repo."""
+        if repo not in chain_depths:
+            # We know there are no cycles so this recursion terminates.
+            chain_depths[repo] = 1 + max((chain_depth(c) for c in rdeps[repo]), default=0)
+        return chain_depths[repo]
+
+    def priority(repo):
+        # The image at the head of the longest remaining chain comes first, with ties going to the one the most images
+        # are waiting on, so that later builds have as much work as possible to run in parallel.
+        return (-chain_depth(repo), -len(rdeps[repo]), repo)
+
+    # Typically many images (e.g. base) have nothing to wait on. Split them off up front and heapify them in one go;
+    # only the rest need to go through the waiting bookkeeping.
+    leaves = [r for r in to_build.keys() if remaining_deps[r] == 0]
+    for r in leaves:
+        log.info('%s has no dependencies and can be built immediately', r)
+    # A heap of the images that we're ready to build (all their dependencies have been built), ordered by priority.
+    ready = [priority(r) for r in leaves]
+    heapq.heapify(ready)
+    # The repo names of the images that are still waiting on some of their dependencies.
+    waiting = {r for r in to_build.keys() if remaining_deps[r] > 0}
+
+    def make_ready(repo):
+        heapq.heappush(ready, priority(repo))
+        waiting.remove(repo)
+
+    # Map from repo name to the version of it that was built (or reused; see build_one).
     built = {}
-    while len(ready) > 0:
-        next_build = next(iter(ready.values()))
-        build_one(next_build, built, push)
-        built[next_build.repo] = next_build
-        del ready[next_build.repo]
-
-        # The following is far less efficient than it might be but it shouldn't matter.
-        for candidate in to_build.values():
-            not_built_yet = [x for x in candidate.deps if x not in built]
-            if len(not_built_yet) > 0:
-                log.debug('%s is still not ready as %s have not been built yet', candidate.repo, not_built_yet)
-            else:
-                log.info('%s is now ready to be built.', candidate.repo)
-                ready[candidate.repo] = candidate
-        for r in ready.keys():
-            del to_build[r]
-
-    if len(to_build) != 0:
+    # Map from the future for a running build to the ImageToBuild it is building.
+    running = {}
+    # Map from the future for a push to the ImageToBuild it is pushing. Images that depend on an image use the local
+    # copy, not the pushed one, so they can be built while it's still being pushed.
+    pushes = {}
+    # Output from one build at a time is readable on the terminal; from more it's a mess so it only goes to the logs.
+    echo = jobs == 1
+    # The repo names of the images whose builds failed. Once anything fails we stop starting new builds.
+    failed_builds = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PUSH_CONCURRENCY) as pusher, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(ready) > 0 or len(running) > 0:
+            # Simple list scheduling: any time there's an idle worker hand it the best image that's ready to be built.
+            while len(failed_builds) == 0 and len(ready) > 0 and len(running) < jobs:
+                _, _, next_repo = heapq.heappop(ready)
+                next_build = to_build[next_repo]
+                # Each build gets its own dict of versions so the worker thread never sees it change under it.
+                dep_versions = dict(prebuilt)
+                dep_versions.update(built)
+                future = executor.submit(build_one, next_build, dep_versions, use_cache, echo)
+                running[future] = next_build
+            if len(running) == 0:
+                # A build failed and everything that was running when it did has now finished.
+                break
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                finished = running.pop(future)
+                try:
+                    version, h = future.result()
+                except Exception as e:
+                    # run_logged has already shown the docker output; anything else is a bug so show the traceback.
+                    log.error('Failed to build %s: %s', finished.repo, e,
+                              exc_info=not isinstance(e, subprocess.CalledProcessError))
+                    failed_builds.append(finished.repo)
+                    continue
+                built[finished.repo] = version
+                if push and version == finished.string_version:
+                    pushes[pusher.submit(push_one, finished, h, echo)] = finished
+
+                # Only the images that depend on the one we just built can have become ready.
+                for child in rdeps[finished.repo]:
+                    remaining_deps[child] -= 1
+                    if remaining_deps[child] > 0:
+                        log.debug('%s is still waiting on %s other images', child, remaining_deps[child])
+                    else:
+                        log.info('%s is now ready to be built.', child)
+                        make_ready(child)
+
+        # Leaving the with block waits for the pushes but we want to say which ones failed.
+        concurrent.futures.wait(pushes)
+
+    failed_pushes = [(img.repo, future.exception()) for future, img in pushes.items()
+                     if future.exception() is not None]
+    for r, e in failed_pushes:
+        log.error('Failed to push %s: %s', r, e)
+
+    if len(failed_builds) != 0:
+        log.error('The following failed to build: %s', ', '.join(sorted(failed_builds)))
+
+    if len(failed_builds) != 0 or len(waiting) != 0 or len(ready) != 0:
         log.error('Unable to build all containers.')
         log.error('The following were not built:')
-        for r in to_build.keys():
+        for r in sorted(set(waiting) | {r for _, _, r in ready} | set(failed_builds)):
             log.error('%s', r)
         sys.exit(1)
 
+    if len(failed_pushes) != 0:
+        sys.exit(1)
+
 
 def main():
     args = parse_args()
@@ -205,27 +660,61 @@ def main():
     all_containers = {}
     for dockerfile_templ in THIS_DIR.glob('*/Dockerfile.template'):
         log.info('Parsing %s', dockerfile_templ)
-        repo = dockerfile_templ.parent.name
-        version = get_max_version(repo) + 1
         with open(dockerfile_templ, 'r') as tf:
-            tokens = chevron.tokenizer.tokenize(tf)
-            deps = [x[1] for x in tokens if x[0] == 'variable']
-            log.info('Found repo %s with version %s and deps %s',
-                     repo, version, deps)
-            all_containers[repo] = ImageToBuild(
+            image = ImageToBuild(
                 directory=dockerfile_templ.parent,
-                version=version,
-                deps=deps)
+                version=None,
+                tokens=list(chevron.tokenizer.tokenize(tf)))
+        log.info('Found repo %s with deps %s', image.repo, image.deps)
+        all_containers[image.repo] = image
 
     # to_build is like all_containers but contains only the images we actually want to build.
     to_build = {}
+    # The images we depend on but aren't building.
+    external_deps = set()
     if args.only is not None:
-        only_set = set(args.only)
-        to_build = {r: c for r, c in all_containers.items() if r in only_set}
+        unknown = [r for r in args.only if r not in all_containers]
+        if len(unknown) > 0:
+            log.error('There is no Dockerfile.template for: %s', ', '.join(unknown))
+            sys.exit(1)
+        if args.no_depends:
+            to_build = {r: all_containers[r] for r in args.only}
+            for c in to_build.values():
+                external_deps.update(d for d in c.deps if d not in to_build and d in all_containers)
+        else:
+            # Add everything the requested images depend on, directly or indirectly.
+            to_explore = list(args.only)
+            while len(to_explore) > 0:
+                r = to_explore.pop()
+                if r in to_build or r not in all_containers:
+                    continue
+                to_build[r] = all_containers[r]
+                to_explore.extend(to_build[r].deps)
     else:
         to_build = copy.copy(all_containers)
 
-    do_builds(to_build, not args.no_push)
+    # Only now that we know what we need do we ask Dockerhub for versions. Fetching the tag data is almost all waiting
+    # on Dockerhub so do it for all the repos at once.
+    repos = sorted(set(to_build.keys()) | external_deps)
+    hub_cache = load_hub_cache()
+    with make_hub_session() as session, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=HUB_CONCURRENCY) as executor:
+        max_versions = dict(zip(repos, executor.map(lambda r: get_max_version(r, session, hub_cache), repos)))
+    save_hub_cache(hub_cache)
+
+    for c in to_build.values():
+        c.version = max_versions[c.repo] + 1
+        log.info('Will build %s with version %s', c.repo, c.version)
+    # With --no_depends there's nothing to build the images we depend on from so they must already be on Dockerhub.
+    unpublished = sorted(r for r in external_deps if max_versions[r] == 0)
+    if len(unpublished) > 0:
+        log.error('--no_depends was given but there is no version on Dockerhub of: %s. Build them first or drop '
+                  '--no_depends.', ', '.join(unpublished))
+        sys.exit(1)
+    # Map from repo name to the version of the images we depend on but aren't building.
+    prebuilt = {r: 'v%03d' % max_versions[r] for r in external_deps}
+
+    do_builds(to_build, prebuilt, not args.no_push, args.jobs, not args.no_cache)
 
 
 if __name__ == '__main__':